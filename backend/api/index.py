@@ -4,15 +4,23 @@ import logging
 import asyncio
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 
 # Add parent directory to path to import app modules
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from app.models import QueryRequest, QueryResponse, LoadDocumentsResponse, HealthResponse
-from app.database import initialize_database, is_database_empty, get_document_count
-from app.rag_chain import query_rag
+from app.database import (
+    initialize_database,
+    is_database_empty,
+    get_document_count,
+    close_db_pool,
+    refresh_hnsw_index,
+)
+from app.rag_chain import query_rag, stream_rag
+from app.faiss_index import faiss_enabled, build_faiss_index
 # document_processor, store_embeddings, get_embedding: lazy-imported in load_documents_internal
-# so serverless (Vercel) doesn't need PyPDF2/python-docx/tiktoken/langchain at import time
+# so serverless (Vercel) doesn't need pypdfium2/python-docx/tiktoken/langchain at import time
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -51,42 +59,120 @@ async def startup_event():
         else:
             doc_count = get_document_count()
             logger.info(f"Database already contains {doc_count} document chunks")
+            if faiss_enabled():
+                # Searches use pgvector until the in-process index is ready
+                asyncio.create_task(build_faiss_index_async())
     except Exception as e:
         logger.error(f"Error during startup: {e}")
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Close pooled database connections."""
+    close_db_pool()
+
+
+async def build_faiss_index_async():
+    """Build the in-process FAISS index without blocking the event loop."""
+    try:
+        await asyncio.to_thread(build_faiss_index)
+    except Exception as e:
+        logger.error(f"Error building FAISS index: {e}")
+
+
 async def load_documents_async(data_folder: str):
     """Async wrapper for loading documents."""
     try:
-        load_documents_internal(data_folder)
+        await load_documents_internal(data_folder)
         logger.info("Documents auto-loaded successfully")
     except Exception as e:
         logger.error(f"Error auto-loading documents: {e}")
 
 
-def load_documents_internal(data_folder: str) -> tuple[int, int]:
+async def load_documents_internal(data_folder: str) -> tuple[int, int]:
     """Internal function to load documents. Returns (chunks_processed, files_processed)."""
-    from app.document_processor import scan_and_process_documents
-    from app.rag_chain import get_embedding
-    from app.vector_store import store_embeddings
+    from app.document_processor import scan_and_process_documents, batch_chunks_by_tokens
+    from app.rag_chain import (
+        async_openai_client,
+        get_embeddings_batch_async,
+        EMBEDDING_BATCH_SIZE,
+        EMBEDDING_BATCH_MAX_TOKENS,
+        EMBEDDING_INPUT_MAX_TOKENS,
+        EMBEDDING_CONCURRENCY,
+    )
+    from app.vector_store import store_embeddings, filter_new_chunks, clear_cached_answers
+    from app.cache import invalidate_answers
 
-    all_chunks, files_processed = scan_and_process_documents(data_folder)
+    files_processed = 0
 
-    if not all_chunks:
-        return 0, files_processed
+    def iter_chunks():
+        nonlocal files_processed
+        for file_chunks in scan_and_process_documents(data_folder):
+            files_processed += 1
+            yield from file_chunks
 
-    logger.info(f"Getting embeddings for {len(all_chunks)} chunks...")
-    embeddings = []
-    for i, chunk in enumerate(all_chunks):
-        if (i + 1) % 10 == 0:
-            logger.info(f"Embedding progress: {i + 1}/{len(all_chunks)}")
-        embedding = get_embedding(chunk['text'])
-        embeddings.append(embedding)
+    # Chunks flow file -> batch -> embed -> store, so only in-flight batches are held in memory
+    batches = batch_chunks_by_tokens(
+        iter_chunks(), EMBEDDING_BATCH_SIZE, EMBEDDING_BATCH_MAX_TOKENS, EMBEDDING_INPUT_MAX_TOKENS
+    )
+    sem = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+    pending = set()
+    chunks_processed = 0
+    completed = 0
+    inserted = 0
+
+    async def embed_and_store(batch):
+        """Embed and store one batch. Returns (chunks handled, chunks newly inserted)."""
+        # Chunks stored by an earlier run are skipped before paying for their embeddings
+        new_chunks = await asyncio.to_thread(filter_new_chunks, batch)
+        if not new_chunks:
+            return len(batch), 0
+        async with sem:
+            batch_embeddings = await get_embeddings_batch_async(
+                async_openai_client, [chunk['text'] for chunk in new_chunks]
+            )
+        batch_inserted = await asyncio.to_thread(store_embeddings, new_chunks, batch_embeddings)
+        return len(batch), batch_inserted
 
-    logger.info("Storing embeddings in database...")
-    store_embeddings(all_chunks, embeddings)
+    try:
+        while True:
+            # Extraction/chunking runs in a thread so in-flight embedding requests keep progressing
+            batch = await asyncio.to_thread(next, batches, None)
+            if batch is None:
+                break
+            chunks_processed += len(batch)
+            pending.add(asyncio.create_task(embed_and_store(batch)))
+            # Let storing overlap embedding, but stop reading ahead once enough batches are queued
+            if len(pending) >= 2 * EMBEDDING_CONCURRENCY:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    batch_completed, batch_inserted = task.result()
+                    completed += batch_completed
+                    inserted += batch_inserted
+                logger.info(f"Embedding progress: {completed}/{chunks_processed} chunks done")
+        for task in asyncio.as_completed(pending):
+            batch_completed, batch_inserted = await task
+            completed += batch_completed
+            inserted += batch_inserted
+        pending = set()
+    finally:
+        for task in pending:
+            task.cancel()
+
+    logger.info(
+        f"Total files processed: {files_processed}, Total chunks processed: {completed}, "
+        f"New chunks stored: {inserted}"
+    )
+    if inserted:
+        # The corpus changed, so answers built from the old context are stale
+        invalidate_answers()
+        clear_cached_answers()
+        # A larger corpus may call for a wider HNSW graph and search
+        await asyncio.to_thread(refresh_hnsw_index)
+        if faiss_enabled():
+            await build_faiss_index_async()
 
-    return len(all_chunks), files_processed
+    return chunks_processed, files_processed
 
 
 @app.get("/api/health", response_model=HealthResponse)
@@ -94,8 +180,8 @@ async def health_check():
     """Health check endpoint."""
     try:
         from app.database import get_db_connection
-        conn = get_db_connection()
-        conn.close()
+        with get_db_connection() as conn:
+            conn.cursor().execute("SELECT 1;")
         database_connected = True
     except Exception as e:
         logger.error(f"Database connection error: {e}")
@@ -122,7 +208,7 @@ async def load_documents():
         # Clear existing chunks (optional - remove if you want to append)
         # clear_all_chunks()
         
-        chunks_processed, files_processed = load_documents_internal(data_folder)
+        chunks_processed, files_processed = await load_documents_internal(data_folder)
         
         return LoadDocumentsResponse(
             message="Documents loaded successfully",
@@ -138,7 +224,7 @@ async def load_documents():
 async def query(request: QueryRequest):
     """Query the RAG system."""
     try:
-        result = query_rag(request.query, top_k=request.top_k)
+        result = query_rag(request.query, top_k=request.top_k, recall_preset=request.recall_preset)
         return QueryResponse(
             answer=result['answer'],
             sources=result['sources']
@@ -148,6 +234,15 @@ async def query(request: QueryRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/api/query/stream")
+async def query_stream(request: QueryRequest):
+    """Query the RAG system, streaming the answer as server-sent events."""
+    return StreamingResponse(
+        stream_rag(request.query, top_k=request.top_k, recall_preset=request.recall_preset),
+        media_type="text/event-stream"
+    )
+
+
 # For local development with uvicorn
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,97 @@
+import os
+import hashlib
+import logging
+from typing import List, Dict, Optional, Any
+
+logger = logging.getLogger(__name__)
+
+RAG_CACHE_DIR = os.getenv("RAG_CACHE_DIR", "/tmp/rag_cache")
+# Seconds before a cached entry expires; bounds how stale an answer can get
+RAG_CACHE_TTL = int(os.getenv("RAG_CACHE_TTL", "86400"))
+
+_EMBEDDING_TAG = "embedding"
+_ANSWER_TAG = "answer"
+
+# diskcache.Cache, opened lazily; False once it turned out to be unavailable
+_cache = None
+
+
+def _get_cache():
+    """Open the disk cache on first use, or return None if caching is unavailable."""
+    global _cache
+    if _cache is None:
+        try:
+            import diskcache
+            # tag_index keeps invalidate_answers fast as the cache grows
+            _cache = diskcache.Cache(RAG_CACHE_DIR, tag_index=True)
+        except Exception as e:
+            logger.warning(f"Disk cache disabled: {e}")
+            _cache = False
+    return _cache if _cache is not False else None
+
+
+def _hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _get(key: tuple) -> Optional[Any]:
+    cache = _get_cache()
+    if cache is None:
+        return None
+    try:
+        return cache.get(key)
+    except Exception as e:
+        logger.warning(f"Error reading from cache: {e}")
+        return None
+
+
+def _set(key: tuple, value: Any, tag: str):
+    cache = _get_cache()
+    if cache is None:
+        return
+    try:
+        cache.set(key, value, expire=RAG_CACHE_TTL, tag=tag)
+    except Exception as e:
+        logger.warning(f"Error writing to cache: {e}")
+
+
+def get_cached_embedding(model: str, text: str) -> Optional[List[float]]:
+    """Look up a cached embedding for text."""
+    return _get((_EMBEDDING_TAG, model, _hash(text)))
+
+
+def set_cached_embedding(model: str, text: str, embedding: List[float]):
+    """Cache the embedding for text."""
+    _set((_EMBEDDING_TAG, model, _hash(text)), embedding, _EMBEDDING_TAG)
+
+
+def get_cached_answer(model: str, prompt: str, top_k: int) -> Optional[Dict[str, Any]]:
+    """Look up a cached RAG result (answer and sources) for a full prompt."""
+    return _get((_ANSWER_TAG, model, _hash(prompt), top_k))
+
+
+def set_cached_answer(model: str, prompt: str, top_k: int, result: Dict[str, Any]):
+    """Cache a RAG result (answer and sources) for a full prompt."""
+    _set((_ANSWER_TAG, model, _hash(prompt), top_k), result, _ANSWER_TAG)
+
+
+def invalidate_answers():
+    """Drop cached answers (e.g. after the document corpus changed). Embeddings stay valid."""
+    cache = _get_cache()
+    if cache is None:
+        return
+    try:
+        cache.evict(_ANSWER_TAG)
+    except Exception as e:
+        logger.warning(f"Error invalidating cached answers: {e}")
+
+
+def clear_cache():
+    """Drop every cached embedding and answer."""
+    cache = _get_cache()
+    if cache is None:
+        return
+    try:
+        cache.clear()
+    except Exception as e:
+        logger.warning(f"Error clearing cache: {e}")
@@ -1,108 +1,359 @@
 import os
 import psycopg2
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from psycopg2.pool import ThreadedConnectionPool
 import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator
 
 logger = logging.getLogger(__name__)
 
+EMBEDDING_DIM = int(os.getenv("EMBEDDING_DIM", "3072"))
+# "halfvec" stores 2 bytes per dimension; "vector" keeps full float32 precision
+EMBEDDING_PRECISION = os.getenv("EMBEDDING_PRECISION", "halfvec")
+if EMBEDDING_PRECISION not in ("vector", "halfvec"):
+    raise ValueError(f"EMBEDDING_PRECISION must be 'vector' or 'halfvec', got {EMBEDDING_PRECISION!r}")
 
-def get_db_connection():
-    """Get database connection from environment variable."""
-    postgres_url = os.getenv("POSTGRES_URL") or os.getenv("DATABASE_URL")
-    if not postgres_url:
-        raise ValueError("POSTGRES_URL or DATABASE_URL environment variable is required")
-    return psycopg2.connect(postgres_url)
+# HNSW parameters by corpus size: (max rows, m, ef_construction, ef_search)
+HNSW_TIERS = [
+    (100_000, 16, 64, 40),
+    (1_000_000, 24, 128, 100),
+    (None, 32, 256, 200),
+]
 
+# ef_search used by searches; tuned to the corpus size in refresh_hnsw_index
+_hnsw_ef_search = HNSW_TIERS[0][3]
 
-def initialize_database():
-    """Initialize database: create pgvector extension and tables if they don't exist."""
-    conn = get_db_connection()
-    conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
-    cursor = conn.cursor()
+DB_POOL_MAX_CONNECTIONS = int(os.getenv("DB_POOL_MAX_CONNECTIONS", "10"))
+# Pooled connections idle for longer than this are checked before reuse
+DB_POOL_IDLE_CHECK_SECONDS = float(os.getenv("DB_POOL_IDLE_CHECK_SECONDS", "60"))
+
+# Created on first use so importing this module never touches the network
+_pool = None
+_pool_lock = threading.Lock()
+# Makes callers wait for a free connection instead of getting PoolError when the pool is exhausted
+_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX_CONNECTIONS)
+# id(connection) -> time.monotonic() when it was last returned to the pool
+_last_used: Dict[int, float] = {}
+
+
+def _get_pool() -> ThreadedConnectionPool:
+    """Get the process-wide connection pool, creating it from the environment on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                postgres_url = os.getenv("POSTGRES_URL") or os.getenv("DATABASE_URL")
+                if not postgres_url:
+                    raise ValueError("POSTGRES_URL or DATABASE_URL environment variable is required")
+                # TCP keepalives make dead idle connections surface sooner
+                _pool = ThreadedConnectionPool(
+                    minconn=1,
+                    maxconn=DB_POOL_MAX_CONNECTIONS,
+                    dsn=postgres_url,
+                    keepalives=1,
+                    keepalives_idle=30,
+                    keepalives_interval=10,
+                    keepalives_count=3
+                )
+    return _pool
+
+
+def _checkout_connection(pool: ThreadedConnectionPool) -> psycopg2.extensions.connection:
+    """
+    Take a live connection from the pool.
     
+    Idle connections may have been closed by the server (Neon drops idle connections),
+    so ones unused for DB_POOL_IDLE_CHECK_SECONDS are checked with a cheap query; dead
+    ones are discarded and the next is tried. Recently used connections skip the check.
+    """
+    # Every pooled connection could be stale, plus one freshly opened connection
+    for _ in range(DB_POOL_MAX_CONNECTIONS + 1):
+        conn = pool.getconn()
+        last_used = _last_used.pop(id(conn), None)
+        if not conn.closed:
+            # Newly opened connections have no last-used time and need no check
+            if last_used is None or time.monotonic() - last_used < DB_POOL_IDLE_CHECK_SECONDS:
+                return conn
+            try:
+                # Autocommit keeps the check to one round trip (no BEGIN / ROLLBACK)
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1;")
+                conn.autocommit = False
+                return conn
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                logger.info(f"Discarding dead pooled connection: {e}")
+        pool.putconn(conn, close=True)
+    raise psycopg2.OperationalError("Could not get a live database connection from the pool")
+
+
+@contextmanager
+def get_db_connection() -> Iterator[psycopg2.extensions.connection]:
+    """
+    Check out a pooled database connection for the duration of a with block.
+    
+    Connections left idle for a while are checked to be alive on checkout. Uncommitted
+    work is rolled back and autocommit is reset before the connection goes back to the
+    pool; connections that failed at the connection level are discarded.
+    """
+    pool = _get_pool()
+    _pool_slots.acquire()
     try:
-        # Enable pgvector extension
-        cursor.execute("CREATE EXTENSION IF NOT EXISTS vector;")
-        logger.info("pgvector extension enabled")
+        conn = _checkout_connection(pool)
+        discard = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            discard = True
+            raise
+        finally:
+            if not discard and not conn.closed:
+                try:
+                    conn.rollback()
+                    conn.autocommit = False
+                except psycopg2.Error:
+                    discard = True
+            pool.putconn(conn, close=discard or bool(conn.closed))
+            if not conn.closed:
+                _last_used[id(conn)] = time.monotonic()
+    finally:
+        _pool_slots.release()
+
+
+def close_db_pool():
+    """Close all pooled connections (called on application shutdown)."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+
+def get_hnsw_params(row_count: int) -> Dict[str, int]:
+    """Pick HNSW build and search parameters for a corpus of row_count vectors."""
+    for max_rows, m, ef_construction, ef_search in HNSW_TIERS:
+        if max_rows is None or row_count < max_rows:
+            return {'m': m, 'ef_construction': ef_construction, 'ef_search': ef_search}
+
+
+def get_hnsw_ef_search() -> int:
+    """Get the default hnsw.ef_search for the current corpus."""
+    return _hnsw_ef_search
+
+
+def _hnsw_index_sql(name: str, params: Dict[str, int], concurrently: bool = False) -> str:
+    """Build the CREATE INDEX statement for the document_chunks HNSW index."""
+    return f"""
+        CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}IF NOT EXISTS {name} 
+        ON document_chunks 
+        USING hnsw (embedding {EMBEDDING_PRECISION}_cosine_ops)
+        WITH (m = {params['m']}, ef_construction = {params['ef_construction']});
+    """
+
+
+def refresh_hnsw_index():
+    """
+    Tune HNSW parameters to the current corpus size.
+    
+    Updates the default ef_search, creates the index if it is missing, and rebuilds it when
+    the corpus moved to a tier with different m / ef_construction (these are fixed at build
+    time). The new index is built concurrently and swapped in, so searches stay indexed
+    and writes are not blocked meanwhile.
+    """
+    global _hnsw_ef_search
+    with get_db_connection() as conn:
+        # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        cursor = conn.cursor()
         
-        # Create documents table with vector column
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS document_chunks (
-                id SERIAL PRIMARY KEY,
-                chunk_text TEXT NOT NULL,
-                embedding vector(3072),
-                source_file TEXT NOT NULL,
-                folder_path TEXT,
-                page_number INTEGER,
-                chunk_index INTEGER,
-                metadata JSONB,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-        """)
+        try:
+            cursor.execute("SELECT COUNT(*) FROM document_chunks;")
+            hnsw_params = get_hnsw_params(cursor.fetchone()[0])
+            _hnsw_ef_search = hnsw_params['ef_search']
+            
+            cursor.execute("SELECT reloptions FROM pg_class WHERE oid = to_regclass('document_chunks_embedding_idx');")
+            row = cursor.fetchone()
+            if row is None:
+                # HNSW needs no training data, so it can be created on an empty table.
+                # Note: vector indexes support up to 2000 dims for vector, 4000 for halfvec
+                cursor.execute(_hnsw_index_sql('document_chunks_embedding_idx', hnsw_params))
+                return
+            
+            # Indexes built without WITH options use pgvector's defaults (m = 16, ef_construction = 64)
+            current = dict(option.split('=', 1) for option in row[0] or [])
+            if (int(current.get('m', 16)) == hnsw_params['m']
+                    and int(current.get('ef_construction', 64)) == hnsw_params['ef_construction']):
+                return
+            
+            logger.info(
+                f"Rebuilding hnsw index with m = {hnsw_params['m']}, "
+                f"ef_construction = {hnsw_params['ef_construction']}"
+            )
+            # Leftover from an interrupted rebuild (a failed concurrent build leaves an invalid index)
+            cursor.execute("DROP INDEX IF EXISTS document_chunks_embedding_idx_new;")
+            cursor.execute(_hnsw_index_sql('document_chunks_embedding_idx_new', hnsw_params, concurrently=True))
+            cursor.execute("DROP INDEX document_chunks_embedding_idx;")
+            cursor.execute("ALTER INDEX document_chunks_embedding_idx_new RENAME TO document_chunks_embedding_idx;")
+        except Exception as e:
+            # A failed rebuild keeps the existing index; only a missing one means sequential scans
+            logger.warning(f"Could not create or rebuild hnsw index: {e}")
+        finally:
+            cursor.close()
+
+
+def _migrate_embedding_column(cursor, table: str, index: str):
+    """
+    Convert an existing embedding column to the configured halfvec type.
+    
+    CREATE TABLE IF NOT EXISTS leaves tables from before halfvec support as vector(N).
+    The conversion rewrites the table once; the vector index on it is dropped first
+    (its operator class does not apply to halfvec) and recreated by the caller.
+    """
+    cursor.execute("""
+        SELECT format_type(atttypid, atttypmod) FROM pg_attribute 
+        WHERE attrelid = %s::regclass AND attname = 'embedding' AND NOT attisdropped;
+    """, (table,))
+    column_type = cursor.fetchone()[0]
+    target_type = f"{EMBEDDING_PRECISION}({EMBEDDING_DIM})"
+    if column_type == target_type:
+        return
+    if EMBEDDING_PRECISION != 'halfvec' or column_type != f"vector({EMBEDDING_DIM})":
+        logger.warning(f"{table}.embedding is {column_type}, expected {target_type}; leaving it unchanged")
+        return
+    
+    logger.info(f"Converting {table}.embedding from {column_type} to {target_type}")
+    cursor.execute(f"DROP INDEX IF EXISTS {index};")
+    cursor.execute(f"""
+        ALTER TABLE {table} 
+        ALTER COLUMN embedding TYPE {target_type} USING embedding::{target_type};
+    """)
+
+
+def initialize_database():
+    """Initialize database: create pgvector extension and tables if they don't exist."""
+    with get_db_connection() as conn:
+        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        cursor = conn.cursor()
         
-        # Create index for vector similarity search
-        # Using ivfflat index for efficient similarity search
-        # Note: lists parameter should be ~rows/1000 for optimal performance
-        # We'll use a default value that works for most cases
         try:
+            # Enable pgvector extension
+            cursor.execute("CREATE EXTENSION IF NOT EXISTS vector;")
+            logger.info("pgvector extension enabled")
+            
+            # Create documents table with vector column
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS document_chunks (
+                    id SERIAL PRIMARY KEY,
+                    chunk_text TEXT NOT NULL,
+                    embedding {EMBEDDING_PRECISION}({EMBEDDING_DIM}),
+                    source_file TEXT NOT NULL,
+                    folder_path TEXT,
+                    page_number INTEGER,
+                    chunk_index INTEGER,
+                    metadata JSONB,
+                    content_hash BYTEA,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+            """)
+            
+            # Identifies a chunk across re-ingestion runs so loading is idempotent
+            # (ADD COLUMN covers tables created before the column existed)
+            cursor.execute("ALTER TABLE document_chunks ADD COLUMN IF NOT EXISTS content_hash BYTEA;")
+            cursor.execute("""
+                CREATE UNIQUE INDEX IF NOT EXISTS document_chunks_content_hash_idx 
+                ON document_chunks (content_hash);
+            """)
+            
+            # Tables created before halfvec support still hold vector(N) embeddings
+            _migrate_embedding_column(cursor, 'document_chunks', 'document_chunks_embedding_idx')
+            
+            # Semantic answer cache: past queries whose answers are reused for near-identical queries
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS cached_queries (
+                    id SERIAL PRIMARY KEY,
+                    query_text TEXT NOT NULL,
+                    embedding {EMBEDDING_PRECISION}({EMBEDDING_DIM}),
+                    answer TEXT NOT NULL,
+                    sources JSONB,
+                    top_k INTEGER,
+                    recall_preset TEXT,
+                    hit_count INTEGER DEFAULT 0,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    last_hit_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+            """)
+            # Columns added after cached_queries was first introduced
+            cursor.execute("""
+                ALTER TABLE cached_queries
+                    ADD COLUMN IF NOT EXISTS top_k INTEGER,
+                    ADD COLUMN IF NOT EXISTS recall_preset TEXT,
+                    ADD COLUMN IF NOT EXISTS last_hit_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP;
+            """)
+            _migrate_embedding_column(cursor, 'cached_queries', 'cached_queries_embedding_idx')
+            try:
+                cursor.execute(f"""
+                    CREATE INDEX IF NOT EXISTS cached_queries_embedding_idx 
+                    ON cached_queries 
+                    USING hnsw (embedding {EMBEDDING_PRECISION}_cosine_ops);
+                """)
+            except Exception as e:
+                logger.warning(f"Could not create hnsw index on cached_queries: {e}")
+            
+            # Create index for source file lookups
             cursor.execute("""
-                CREATE INDEX IF NOT EXISTS document_chunks_embedding_idx 
-                ON document_chunks 
-                USING ivfflat (embedding vector_cosine_ops)
-                WITH (lists = 100);
+                CREATE INDEX IF NOT EXISTS document_chunks_source_file_idx 
+                ON document_chunks (source_file);
             """)
+            
+            conn.commit()
+            logger.info("Database tables initialized")
+            
         except Exception as e:
-            # If ivfflat fails (e.g., no data yet), create a simple index
-            logger.warning(f"Could not create ivfflat index: {e}. Will create after data is loaded.")
-            # The index will be created automatically when data is inserted
-        
-        # Create index for source file lookups
-        cursor.execute("""
-            CREATE INDEX IF NOT EXISTS document_chunks_source_file_idx 
-            ON document_chunks (source_file);
-        """)
-        
-        conn.commit()
-        logger.info("Database tables initialized")
-        
-    except Exception as e:
-        logger.error(f"Error initializing database: {e}")
-        raise
-    finally:
-        cursor.close()
-        conn.close()
+            logger.error(f"Error initializing database: {e}")
+            raise
+        finally:
+            cursor.close()
+    
+    # Vector similarity index, tuned to the corpus size
+    refresh_hnsw_index()
+    
+    # Rows from before content_hash existed need it for idempotent loads.
+    # Imported here because vector_store depends on this module.
+    from app.vector_store import backfill_content_hashes
+    backfill_content_hashes()
 
 
 def is_database_empty():
     """Check if the database has any document chunks."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    try:
-        cursor.execute("SELECT COUNT(*) FROM document_chunks;")
-        count = cursor.fetchone()[0]
-        return count == 0
-    except Exception as e:
-        logger.error(f"Error checking database: {e}")
-        # If table doesn't exist, consider it empty
-        return True
-    finally:
-        cursor.close()
-        conn.close()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute("SELECT COUNT(*) FROM document_chunks;")
+            count = cursor.fetchone()[0]
+            return count == 0
+        except Exception as e:
+            logger.error(f"Error checking database: {e}")
+            # If table doesn't exist, consider it empty
+            return True
+        finally:
+            cursor.close()
 
 
 def get_document_count():
     """Get the number of document chunks in the database."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    try:
-        cursor.execute("SELECT COUNT(*) FROM document_chunks;")
-        count = cursor.fetchone()[0]
-        return count
-    except Exception as e:
-        logger.error(f"Error getting document count: {e}")
-        return 0
-    finally:
-        cursor.close()
-        conn.close()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute("SELECT COUNT(*) FROM document_chunks;")
+            count = cursor.fetchone()[0]
+            return count
+        except Exception as e:
+            logger.error(f"Error getting document count: {e}")
+            return 0
+        finally:
+            cursor.close()
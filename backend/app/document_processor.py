@@ -1,36 +1,105 @@
 import os
 import logging
+import functools
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path
-from typing import List, Dict, Any
-import PyPDF2
-from docx import Document
-import tiktoken
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+from typing import List, Dict, Any, Iterable, Iterator
+
+# pypdfium2, python-docx, tiktoken and langchain are imported inside the functions that
+# use them, so importing this module stays cheap on serverless cold starts
 
 logger = logging.getLogger(__name__)
 
-# Initialize tokenizer for token counting
-encoding = tiktoken.get_encoding("cl100k_base")
+
+@functools.lru_cache(maxsize=None)
+def _get_encoding():
+    """Load the tokenizer used for token counting on first use."""
+    import tiktoken
+    return tiktoken.get_encoding("cl100k_base")
 
 
 def count_tokens(text: str) -> int:
     """Count tokens in text using tiktoken."""
-    return len(encoding.encode(text))
+    return len(_get_encoding().encode(text))
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def _count_tokens_cached(text: str) -> int:
+    """
+    Memoized count_tokens for the text splitter, which re-measures overlapping pieces.
+    
+    process_document clears it after each document, so it never pins a whole corpus of strings.
+    """
+    return count_tokens(text)
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cut text down to its first max_tokens tokens."""
+    encoding = _get_encoding()
+    return encoding.decode(encoding.encode(text)[:max_tokens])
+
+
+def batch_chunks_by_tokens(
+    chunks: Iterable[Dict[str, Any]],
+    max_chunks: int,
+    max_tokens: int,
+    max_input_tokens: int
+) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Group chunks into batches bounded by chunk count and total token count.
+    
+    Args:
+        chunks: Iterable of chunk dictionaries with a 'text' key (consumed lazily)
+        max_chunks: Maximum number of chunks per batch
+        max_tokens: Maximum total tokens per batch (a single larger chunk gets its own batch)
+        max_input_tokens: Maximum tokens per chunk; longer chunks are truncated
+    
+    Yields:
+        Batches of chunks, preserving chunk order
+    """
+    batch = []
+    batch_tokens = 0
+    for chunk in chunks:
+        tokens = count_tokens(chunk['text'])
+        if tokens > max_input_tokens:
+            # The splitter keeps chunks far below this; truncating beats failing the whole request
+            logger.warning(
+                f"Truncating chunk {chunk['chunk_index']} of {chunk['source_file']} "
+                f"from {tokens} to {max_input_tokens} tokens"
+            )
+            chunk = {**chunk, 'text': truncate_to_tokens(chunk['text'], max_input_tokens)}
+            tokens = max_input_tokens
+        if batch and (len(batch) >= max_chunks or batch_tokens + tokens > max_tokens):
+            yield batch
+            batch = []
+            batch_tokens = 0
+        batch.append(chunk)
+        batch_tokens += tokens
+    if batch:
+        yield batch
 
 
 def extract_text_from_pdf(file_path: str) -> List[Dict[str, Any]]:
     """Extract text from PDF file, returning pages with text and page numbers."""
+    import pypdfium2 as pdfium
+    
     pages = []
     try:
-        with open(file_path, 'rb') as file:
-            pdf_reader = PyPDF2.PdfReader(file)
-            for page_num, page in enumerate(pdf_reader.pages, start=1):
-                text = page.extract_text()
+        pdf = pdfium.PdfDocument(file_path)
+        try:
+            for page_num, page in enumerate(pdf, start=1):
+                textpage = page.get_textpage()
+                # PDFium separates lines with \r\n; normalize so the splitter's "\n" separators apply
+                text = textpage.get_text_bounded().replace('\r\n', '\n')
+                textpage.close()
+                page.close()
                 if text.strip():
                     pages.append({
                         'text': text,
                         'page_number': page_num
                     })
+        finally:
+            pdf.close()
         logger.info(f"Extracted {len(pages)} pages from PDF: {file_path}")
     except Exception as e:
         logger.error(f"Error extracting text from PDF {file_path}: {e}")
@@ -40,6 +109,8 @@ def extract_text_from_pdf(file_path: str) -> List[Dict[str, Any]]:
 
 def extract_text_from_docx(file_path: str) -> List[Dict[str, Any]]:
     """Extract text from Word document."""
+    from docx import Document
+    
     try:
         doc = Document(file_path)
         full_text = []
@@ -60,11 +131,24 @@ def extract_text_from_docx(file_path: str) -> List[Dict[str, Any]]:
     return []
 
 
+@functools.lru_cache(maxsize=None)
+def _get_text_splitter(chunk_size: int, chunk_overlap: int):
+    """Build the text splitter once per (chunk_size, chunk_overlap) instead of once per page."""
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    
+    # Use RecursiveCharacterTextSplitter which respects paragraph/sentence boundaries
+    return RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        length_function=_count_tokens_cached,
+        separators=["\n\n", "\n", ". ", " ", ""]  # Try to split at paragraphs, then sentences
+    )
+
+
 def chunk_text_by_tokens(
     text: str,
     chunk_size: int = 1000,
-    chunk_overlap: int = 200,
-    respect_sentences: bool = True
+    chunk_overlap: int = 200
 ) -> List[str]:
     """
     Chunk text by tokens, respecting paragraph and sentence boundaries.
@@ -73,21 +157,11 @@ def chunk_text_by_tokens(
         text: Text to chunk
         chunk_size: Target chunk size in tokens
         chunk_overlap: Overlap between chunks in tokens
-        respect_sentences: Whether to respect sentence boundaries
     
     Returns:
         List of text chunks
     """
-    # Use RecursiveCharacterTextSplitter which respects paragraph/sentence boundaries
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=chunk_size,
-        chunk_overlap=chunk_overlap,
-        length_function=count_tokens,
-        separators=["\n\n", "\n", ". ", " ", ""]  # Try to split at paragraphs, then sentences
-    )
-    
-    chunks = text_splitter.split_text(text)
-    return chunks
+    return _get_text_splitter(chunk_size, chunk_overlap).split_text(text)
 
 
 def process_document(file_path: str, base_path: str) -> List[Dict[str, Any]]:
@@ -147,38 +221,72 @@ def process_document(file_path: str, base_path: str) -> List[Dict[str, Any]]:
     except Exception as e:
         logger.error(f"Error processing document {file_path}: {e}")
         # Continue processing other documents even if one fails
+    finally:
+        # Splitter pieces are only re-measured within a document
+        _count_tokens_cached.cache_clear()
     
     return chunks
 
 
-def scan_and_process_documents(data_folder: str) -> tuple[List[Dict[str, Any]], int]:
+def scan_and_process_documents(data_folder: str) -> Iterator[List[Dict[str, Any]]]:
     """
-    Recursively scan data folder for PDFs and Word docs, process them, and return all chunks.
+    Recursively scan data folder for PDFs and Word docs and process them one file at a time.
     
     Args:
         data_folder: Path to the data folder
     
-    Returns:
-        Tuple of (list of all document chunks with metadata, number of files processed)
+    Yields:
+        List of chunks with metadata for each processed file (possibly empty)
     """
-    all_chunks = []
     data_path = Path(data_folder)
     
     if not data_path.exists():
         logger.error(f"Data folder does not exist: {data_folder}")
-        return (all_chunks, 0)
+        return
     
     # Supported file extensions
     supported_extensions = {'.pdf', '.docx', '.doc'}
     
     # Recursively find all PDF and Word documents
-    files_processed = 0
-    for file_path in data_path.rglob('*'):
-        if file_path.is_file() and file_path.suffix.lower() in supported_extensions:
+    files = [
+        file_path for file_path in data_path.rglob('*')
+        if file_path.is_file() and file_path.suffix.lower() in supported_extensions
+    ]
+    
+    # Text extraction is CPU-bound, so spread files across processes.
+    # Only a few files per worker are in flight: workers finish far sooner than the
+    # network-bound consumer, and submitting everything up front would hold every
+    # file's chunks in memory at once.
+    max_workers = os.cpu_count() or 1
+    max_in_flight = 2 * max_workers
+    remaining = iter(files)
+    futures = {}
+    
+    def submit_next():
+        file_path = next(remaining, None)
+        if file_path is not None:
+            futures[executor.submit(process_document, str(file_path), str(data_path))] = file_path
+    
+    executor = None
+    try:
+        executor = ProcessPoolExecutor(max_workers=max_workers)
+        for _ in range(max_in_flight):
+            submit_next()
+    except (OSError, NotImplementedError) as e:
+        # Some sandboxes (e.g. serverless runtimes) cannot start worker processes
+        logger.warning(f"Process pool unavailable ({e}), processing documents sequentially")
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        for file_path in files:
             logger.info(f"Processing: {file_path}")
-            chunks = process_document(str(file_path), str(data_path))
-            all_chunks.extend(chunks)
-            files_processed += 1
+            yield process_document(str(file_path), str(data_path))
+        return
     
-    logger.info(f"Total files processed: {files_processed}, Total chunks created: {len(all_chunks)}")
-    return all_chunks, files_processed
+    with executor:
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                logger.info(f"Processed: {futures.pop(future)}")
+                # Keep the workers busy while the consumer handles this file's chunks
+                submit_next()
+                yield future.result()
@@ -0,0 +1,104 @@
+import os
+import logging
+import threading
+from typing import List, Tuple
+from app.database import get_db_connection, EMBEDDING_PRECISION, EMBEDDING_DIM
+
+# faiss and numpy are optional: only imported when VECTOR_SEARCH_BACKEND=faiss
+
+logger = logging.getLogger(__name__)
+
+# "pgvector" searches in the database; "faiss" keeps an in-process HNSW index of all chunks
+VECTOR_SEARCH_BACKEND = os.getenv("VECTOR_SEARCH_BACKEND", "pgvector")
+FAISS_HNSW_M = 32
+# Rows fetched per round-trip while loading embeddings
+FAISS_LOAD_BATCH_SIZE = 5000
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def faiss_enabled() -> bool:
+    """Whether the in-process FAISS index is configured as the search backend."""
+    return VECTOR_SEARCH_BACKEND == "faiss"
+
+
+def faiss_index_ready() -> bool:
+    """Whether the FAISS backend is configured and its index has been built."""
+    return faiss_enabled() and _index is not None
+
+
+def build_faiss_index():
+    """
+    Load every stored embedding into an in-process FAISS HNSW index (inner product on
+    normalized vectors, i.e. cosine similarity), replacing the current index.
+    """
+    global _index
+    import faiss
+    import numpy as np
+
+    # <type>_send gives pgvector's binary layout: int16 dim, int16 unused, big-endian values
+    dtype = np.dtype('>f2') if EMBEDDING_PRECISION == 'halfvec' else np.dtype('>f4')
+    index = faiss.IndexIDMap(faiss.IndexHNSWFlat(EMBEDDING_DIM, FAISS_HNSW_M, faiss.METRIC_INNER_PRODUCT))
+
+    with get_db_connection() as conn:
+        # Named (server-side) cursor streams rows instead of loading the whole table at once
+        cursor = conn.cursor(name="faiss_index_load")
+        cursor.itersize = FAISS_LOAD_BATCH_SIZE
+
+        try:
+            cursor.execute(f"SELECT id, {EMBEDDING_PRECISION}_send(embedding) FROM document_chunks WHERE embedding IS NOT NULL;")
+            while True:
+                rows = cursor.fetchmany(FAISS_LOAD_BATCH_SIZE)
+                if not rows:
+                    break
+                ids = np.array([row[0] for row in rows], dtype=np.int64)
+                vectors = np.vstack([
+                    np.frombuffer(bytes(row[1]), dtype=dtype, offset=4) for row in rows
+                ]).astype(np.float32)
+                faiss.normalize_L2(vectors)
+                index.add_with_ids(vectors, ids)
+        except Exception as e:
+            logger.error(f"Error building FAISS index: {e}")
+            raise
+        finally:
+            cursor.close()
+
+    with _index_lock:
+        _index = index
+    logger.info(f"FAISS index built with {index.ntotal} vectors")
+
+
+def reset_faiss_index():
+    """Drop the in-process index (e.g. after all chunks were deleted)."""
+    global _index
+    with _index_lock:
+        _index = None
+
+
+def search_faiss_index(query_embedding: List[float], top_k: int, ef_search: int) -> List[Tuple[int, float]]:
+    """
+    Find the nearest chunks in the in-process index.
+
+    Args:
+        query_embedding: Query embedding vector
+        top_k: Number of results to return
+        ef_search: HNSW search breadth (higher trades latency for recall)
+
+    Returns:
+        List of (document_chunks.id, cosine similarity), most similar first
+    """
+    import faiss
+    import numpy as np
+
+    with _index_lock:
+        index = _index
+    if index is None:
+        raise RuntimeError("FAISS index has not been built")
+
+    query = np.asarray(query_embedding, dtype=np.float32).reshape(1, -1)
+    faiss.normalize_L2(query)
+    params = faiss.SearchParametersHNSW(efSearch=ef_search)
+    scores, ids = index.search(query, top_k, params=params)
+    # FAISS pads with id -1 when fewer than top_k vectors exist
+    return [(int(i), float(s)) for i, s in zip(ids[0], scores[0]) if i != -1]
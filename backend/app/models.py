@@ -1,10 +1,11 @@
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import List, Optional, Literal
 
 
 class QueryRequest(BaseModel):
     query: str
     top_k: int = 5
+    recall_preset: Literal["fast", "balanced", "high"] = "balanced"
 
 
 class QueryResponse(BaseModel):
@@ -1,109 +1,265 @@
 import os
+import json
 import logging
-from typing import List, Dict
-from openai import OpenAI
-from app.vector_store import search_similar_chunks
+import asyncio
+import functools
+from typing import List, Dict, AsyncIterator
+from openai import OpenAI, AsyncOpenAI, RateLimitError
+from app.vector_store import search_similar_chunks, search_cached_answer, store_cached_answer
+from app.cache import get_cached_embedding, set_cached_embedding, get_cached_answer, set_cached_answer
 
 logger = logging.getLogger(__name__)
 
 # Initialize OpenAI client
 openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+async_openai_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")
 OPENAI_EMBEDDING_MODEL = os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-3-large")
+# Embedding batches are capped by chunk count and by total tokens per request
+# (the API accepts about 300k tokens per request)
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "128"))
+EMBEDDING_BATCH_MAX_TOKENS = int(os.getenv("EMBEDDING_BATCH_MAX_TOKENS", "250000"))
+# The API rejects any single input longer than this
+EMBEDDING_INPUT_MAX_TOKENS = 8192
+# Number of embedding requests allowed in flight at once during document loading
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", "16"))
+EMBEDDING_MAX_RETRIES = 5
 
 
 def get_embedding(text: str) -> List[float]:
+    cached = get_cached_embedding(OPENAI_EMBEDDING_MODEL, text)
+    if cached is not None:
+        return cached
     try:
         response = openai_client.embeddings.create(
             model=OPENAI_EMBEDDING_MODEL,
             input=text
         )
-        return response.data[0].embedding
+        embedding = response.data[0].embedding
+        set_cached_embedding(OPENAI_EMBEDDING_MODEL, text, embedding)
+        return embedding
     except Exception as e:
         logger.error(f"Error getting embedding: {e}")
         raise
 
 
+async def get_embeddings_batch_async(client: AsyncOpenAI, texts: List[str]) -> List[List[float]]:
+    """
+    Embed a batch of texts in a single async request, retrying with exponential backoff on rate limits.
+    
+    Args:
+        client: AsyncOpenAI client
+        texts: Texts to embed
+    
+    Returns:
+        List of embedding vectors, in the same order as texts
+    """
+    for attempt in range(EMBEDDING_MAX_RETRIES + 1):
+        try:
+            response = await client.embeddings.create(
+                model=OPENAI_EMBEDDING_MODEL,
+                input=texts
+            )
+            return [item.embedding for item in sorted(response.data, key=lambda d: d.index)]
+        except RateLimitError as e:
+            if attempt == EMBEDDING_MAX_RETRIES:
+                logger.error(f"Rate limited getting batch embeddings, giving up: {e}")
+                raise
+            delay = 2 ** attempt
+            logger.warning(f"Rate limited getting batch embeddings, retrying in {delay}s...")
+            await asyncio.sleep(delay)
+        except Exception as e:
+            logger.error(f"Error getting batch embeddings: {e}")
+            raise
+
+
+@functools.lru_cache(maxsize=4096)
+def _format_citation(folder, base, page) -> str:
+    # Memoized: the same chunks tend to come back across queries
+    if folder and page:
+        return f"{folder} > {base} > Page {page}"
+    if folder:
+        return f"{folder} > {base}"
+    if page:
+        return f"{base} > Page {page}"
+    return base
+
+
 def format_source_citation(chunk: Dict[str, any]) -> str:
     """Format a chunk into a source citation string."""
-    parts = []
+    return _format_citation(chunk.get('folder_path'), chunk['source_file'], chunk.get('page_number'))
+
+
+def _prepare_rag(user_query: str, top_k: int, recall_preset: str) -> Dict[str, any]:
+    """
+    Run the retrieval half of a RAG query: embed, check caches, search, build the prompt.
     
-    if chunk.get('folder_path'):
-        parts.append(chunk['folder_path'])
+    Returns:
+        Dictionary with 'result' set to a final answer/sources dict when no generation is
+        needed (cache hit or nothing found); otherwise 'messages' for the chat call plus
+        'sources', 'cache_prompt', 'query_embedding' and 'recall_preset' for remembering the answer.
+    """
+    # Step 1: Embed the query
+    logger.info(f"Embedding query: {user_query[:50]}...")
+    query_embedding = get_embedding(user_query)
     
-    parts.append(chunk['source_file'])
+    # Reuse the answer to a near-identical earlier query if there is one
+    cached = search_cached_answer(query_embedding, top_k, recall_preset)
+    if cached is not None:
+        logger.info("Returning semantically cached answer")
+        return {'result': cached}
     
-    if chunk.get('page_number'):
-        parts.append(f"Page {chunk['page_number']}")
+    # Step 2: Search for similar chunks
+    logger.info(f"Searching for similar chunks (top_k={top_k})...")
+    similar_chunks = search_similar_chunks(query_embedding, top_k=top_k, recall_preset=recall_preset)
     
-    return " > ".join(parts)
+    if not similar_chunks:
+        return {'result': {
+            'answer': "I couldn't find any relevant information in the documents to answer your question.",
+            'sources': []
+        }}
+    
+    # Step 3: Build context from retrieved chunks
+    context_parts = []
+    sources = []
+    seen_sources = set()
+    
+    for chunk in similar_chunks:
+        source_citation = format_source_citation(chunk)
+        context_parts.append(f"[Source: {source_citation}]\n{chunk['text']}")
+        if source_citation not in seen_sources:
+            seen_sources.add(source_citation)
+            sources.append(source_citation)
+    
+    context = "\n\n---\n\n".join(context_parts)
+    
+    # Step 4: Build prompt for OpenAI
+    system_prompt = """You are a helpful assistant named Bolt that answers questions based on the provided context from documents. 
+Use only the information from the context to answer the question. If the context doesn't contain enough information to answer the question, say so."""
+    
+    user_prompt = f"""Context from documents: {context}
+        Question: {user_query}
+"""
+    
+    # Same prompt (query + retrieved context) means the same answer
+    cache_prompt = system_prompt + user_prompt
+    cached = get_cached_answer(OPENAI_MODEL, cache_prompt, top_k)
+    if cached is not None:
+        logger.info("Returning cached answer")
+        return {'result': cached}
+    
+    return {
+        'result': None,
+        'messages': [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        'sources': sources,
+        'cache_prompt': cache_prompt,
+        'query_embedding': query_embedding,
+        'recall_preset': recall_preset
+    }
+
 
+def _remember_answer(user_query: str, top_k: int, prepared: Dict[str, any], answer: str) -> Dict[str, any]:
+    """Store a generated answer in the exact and semantic caches and return the result dict."""
+    result = {
+        'answer': answer,
+        'sources': prepared['sources']
+    }
+    set_cached_answer(OPENAI_MODEL, prepared['cache_prompt'], top_k, result)
+    store_cached_answer(
+        user_query, prepared['query_embedding'], answer, prepared['sources'], top_k, prepared['recall_preset']
+    )
+    return result
 
-def query_rag(user_query: str, top_k: int = 5) -> Dict[str, any]:
+
+def query_rag(user_query: str, top_k: int = 5, recall_preset: str = "balanced") -> Dict[str, any]:
     """
     Perform RAG query: embed query, search for similar chunks, generate answer.
     
     Args:
         user_query: User's question
         top_k: Number of similar chunks to retrieve
+        recall_preset: Search recall/latency trade-off ('fast', 'balanced' or 'high')
     
     Returns:
         Dictionary with answer and sources
     """
     try:
-        # Step 1: Embed the query
-        logger.info(f"Embedding query: {user_query[:50]}...")
-        query_embedding = get_embedding(user_query)
-        
-        # Step 2: Search for similar chunks
-        logger.info(f"Searching for similar chunks (top_k={top_k})...")
-        similar_chunks = search_similar_chunks(query_embedding, top_k=top_k)
-        
-        if not similar_chunks:
-            return {
-                'answer': "I couldn't find any relevant information in the documents to answer your question.",
-                'sources': []
-            }
-        
-        # Step 3: Build context from retrieved chunks
-        context_parts = []
-        sources = []
-        
-        for chunk in similar_chunks:
-            context_parts.append(f"[Source: {format_source_citation(chunk)}]\n{chunk['text']}")
-            source_citation = format_source_citation(chunk)
-            if source_citation not in sources:
-                sources.append(source_citation)
-        
-        context = "\n\n---\n\n".join(context_parts)
-        
-        # Step 4: Build prompt for OpenAI
-        system_prompt = """You are a helpful assistant named Bolt that answers questions based on the provided context from documents. 
-Use only the information from the context to answer the question. If the context doesn't contain enough information to answer the question, say so."""
-        
-        user_prompt = f"""Context from documents: {context}
-        Question: {user_query}
-"""
+        prepared = _prepare_rag(user_query, top_k, recall_preset)
+        if prepared['result'] is not None:
+            return prepared['result']
         
         # Step 5: Call OpenAI to generate answer
         logger.info("Generating answer with OpenAI...")
         response = openai_client.chat.completions.create(
             model=OPENAI_MODEL,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
+            messages=prepared['messages'],
             temperature=0.7,
             max_tokens=1000
         )
         
         answer = response.choices[0].message.content or ""
 
-        return {
-            'answer': answer,
-            'sources': sources
-        }
+        return _remember_answer(user_query, top_k, prepared, answer)
         
     except Exception as e:
         logger.error(f"Error in RAG query: {e}")
         raise
+
+
+def _sse(event: str, data: any) -> str:
+    """Format one server-sent event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def stream_rag(user_query: str, top_k: int = 5, recall_preset: str = "balanced") -> AsyncIterator[str]:
+    """
+    Perform a RAG query, streaming the answer as server-sent events while it is generated.
+    
+    Events: 'sources' (list of citations) first, then one 'delta' per piece of answer text,
+    then 'done'. Failures after the stream has started are reported as an 'error' event.
+    
+    Args:
+        user_query: User's question
+        top_k: Number of similar chunks to retrieve
+        recall_preset: Search recall/latency trade-off ('fast', 'balanced' or 'high')
+    
+    Yields:
+        Server-sent event strings
+    """
+    try:
+        # Retrieval is blocking (sync OpenAI client, database), so keep it off the event loop
+        prepared = await asyncio.to_thread(_prepare_rag, user_query, top_k, recall_preset)
+        if prepared['result'] is not None:
+            yield _sse('sources', prepared['result']['sources'])
+            yield _sse('delta', prepared['result']['answer'])
+            yield _sse('done', {})
+            return
+        
+        yield _sse('sources', prepared['sources'])
+        
+        logger.info("Streaming answer from OpenAI...")
+        stream = await async_openai_client.chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=prepared['messages'],
+            temperature=0.7,
+            max_tokens=1000,
+            stream=True
+        )
+        answer_parts = []
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                answer_parts.append(delta)
+                yield _sse('delta', delta)
+        
+        await asyncio.to_thread(_remember_answer, user_query, top_k, prepared, "".join(answer_parts))
+        yield _sse('done', {})
+        
+    except Exception as e:
+        logger.error(f"Error in streaming RAG query: {e}")
+        yield _sse('error', {'detail': str(e)})
@@ -1,79 +1,360 @@
 import os
+import io
+import hashlib
 import logging
 import json
+import struct
 from typing import List, Dict, Optional, Any
 import psycopg2
 from psycopg2.extras import execute_values
-from app.database import get_db_connection
+from app.database import get_db_connection, get_hnsw_ef_search, EMBEDDING_PRECISION, EMBEDDING_DIM
+from app.cache import clear_cache
+from app.faiss_index import faiss_index_ready, search_faiss_index, reset_faiss_index
 
 logger = logging.getLogger(__name__)
 
+# PostgreSQL binary COPY framing: signature, flags field, header extension length
+_PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+_PGCOPY_TRAILER = struct.pack('!h', -1)
+_PGCOPY_NULL = struct.pack('!i', -1)
+_JSONB_VERSION = b'\x01'
+# Scale factors applied to the corpus-tuned hnsw.ef_search; higher trades latency for recall
+RECALL_PRESETS = {
+    'fast': 0.5,
+    'balanced': 1.0,
+    'high': 4.0,
+}
+HNSW_MAX_EF_SEARCH = 1000
+
+# Minimum cosine similarity for a past query's answer to be reused
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("RAG_SEMANTIC_CACHE_THRESHOLD", "0.97"))
+# Rows kept in cached_queries; the least recently used entries are dropped first
+SEMANTIC_CACHE_MAX_ROWS = int(os.getenv("RAG_SEMANTIC_CACHE_MAX_ROWS", "1000"))
+
+# halfvec is sent as float16 values, vector as float32
+_VECTOR_ELEMENT_FORMAT = 'e' if EMBEDDING_PRECISION == 'halfvec' else 'f'
+
+
+def _copy_field(value: Optional[bytes]) -> bytes:
+    """Encode a single binary COPY field as length-prefixed bytes (or NULL)."""
+    if value is None:
+        return _PGCOPY_NULL
+    return struct.pack('!i', len(value)) + value
+
+
+def _copy_int(value: Optional[int]) -> bytes:
+    """Encode an INTEGER column value for binary COPY."""
+    return _copy_field(None if value is None else struct.pack('!i', value))
+
+
+def _copy_text(value: Optional[str]) -> bytes:
+    """Encode a TEXT column value for binary COPY."""
+    return _copy_field(None if value is None else value.encode('utf-8'))
+
+
+def _to_vector_literal(embedding: List[float]) -> str:
+    """Convert an embedding to PostgreSQL vector text format (bind it by name to quote it once per statement)."""
+    return '[' + ','.join(map(str, embedding)) + ']'
+
+
+def _encode_vector(embedding: List[float]) -> bytes:
+    """Encode an embedding in pgvector's binary layout: int16 dim, int16 unused, then the values."""
+    dim = len(embedding)
+    return struct.pack(f'!hh{dim}{_VECTOR_ELEMENT_FORMAT}', dim, 0, *embedding)
+
+
+def _clean_chunk_text(text: str) -> str:
+    """Remove null bytes (PostgreSQL doesn't allow them) and surrounding whitespace."""
+    return text.replace('\x00', '').strip()
+
+
+def chunk_content_hash(chunk: Dict[str, Any]) -> bytes:
+    """
+    Compute the SHA-256 identity of a chunk: its location (file, page, index) and its text.
+    
+    The location is included so identical text in two documents (e.g. shared templates)
+    keeps a row, and a citation, per document.
+    """
+    parts = [
+        chunk.get('metadata', {}).get('file_path') or chunk['source_file'],
+        str(chunk.get('page_number')),
+        str(chunk.get('chunk_index')),
+        _clean_chunk_text(chunk['text']),
+    ]
+    return hashlib.sha256('\x00'.join(parts).encode('utf-8')).digest()
+
+
+def backfill_content_hashes(batch_size: int = 1000) -> int:
+    """
+    Fill content_hash for rows stored before the column existed.
+    
+    Without it the unique index cannot match those rows, so the next load would embed and
+    insert the whole corpus again. Rows whose hash is already taken are extra copies of the
+    same chunk (from earlier non-idempotent loads) and are deleted.
+    
+    Args:
+        batch_size: Rows hashed per transaction
+    
+    Returns:
+        Number of rows backfilled
+    """
+    backfilled = 0
+    deleted = 0
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        
+        try:
+            while True:
+                cursor.execute("""
+                    SELECT id, chunk_text, source_file, page_number, chunk_index, metadata
+                    FROM document_chunks
+                    WHERE content_hash IS NULL
+                    ORDER BY id
+                    LIMIT %s
+                """, (batch_size,))
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                
+                hashes = []
+                for row in rows:
+                    metadata = row[5] if row[5] else {}
+                    if isinstance(metadata, str):
+                        metadata = json.loads(metadata)
+                    hashes.append((row[0], chunk_content_hash({
+                        'text': row[1],
+                        'source_file': row[2],
+                        'page_number': row[3],
+                        'chunk_index': row[4],
+                        'metadata': metadata
+                    })))
+                
+                cursor.execute(
+                    "SELECT content_hash FROM document_chunks WHERE content_hash = ANY(%s);",
+                    ([psycopg2.Binary(h) for _, h in hashes],)
+                )
+                taken = {bytes(row[0]) for row in cursor.fetchall()}
+                updates = []
+                duplicate_ids = []
+                for row_id, h in hashes:
+                    if h in taken:
+                        duplicate_ids.append(row_id)
+                    else:
+                        taken.add(h)
+                        updates.append((row_id, psycopg2.Binary(h)))
+                
+                if duplicate_ids:
+                    cursor.execute("DELETE FROM document_chunks WHERE id = ANY(%s);", (duplicate_ids,))
+                if updates:
+                    execute_values(cursor, """
+                        UPDATE document_chunks AS d SET content_hash = v.content_hash
+                        FROM (VALUES %s) AS v (id, content_hash)
+                        WHERE d.id = v.id
+                    """, updates)
+                conn.commit()
+                backfilled += len(updates)
+                deleted += len(duplicate_ids)
+            
+            if backfilled or deleted:
+                logger.info(f"Backfilled content_hash for {backfilled} chunks, removed {deleted} duplicates")
+            return backfilled
+            
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Error backfilling content hashes: {e}")
+            raise
+        finally:
+            cursor.close()
+
+
+def filter_new_chunks(chunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Drop chunks that are already stored, so re-ingesting unchanged documents skips embedding.
+    
+    Args:
+        chunks: List of chunk dictionaries with metadata
+    
+    Returns:
+        Chunks whose content hash is not yet in the database, in their original order
+    """
+    if not chunks:
+        return []
+    
+    hashes = [chunk_content_hash(chunk) for chunk in chunks]
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute(
+                "SELECT content_hash FROM document_chunks WHERE content_hash = ANY(%s);",
+                ([psycopg2.Binary(h) for h in hashes],)
+            )
+            existing = {bytes(row[0]) for row in cursor.fetchall()}
+        except Exception as e:
+            logger.error(f"Error checking existing chunks: {e}")
+            raise
+        finally:
+            cursor.close()
+    
+    return [chunk for chunk, h in zip(chunks, hashes) if h not in existing]
+
 
 def store_embeddings(chunks: List[Dict[str, Any]], embeddings: List[List[float]]):
     """
     Store document chunks and their embeddings in the database.
     
+    Chunks that are already stored (same content hash) are skipped.
+    
     Args:
         chunks: List of chunk dictionaries with metadata
         embeddings: List of embedding vectors (each is a list of floats)
+    
+    Returns:
+        Number of chunks actually inserted
     """
     if len(chunks) != len(embeddings):
         raise ValueError(f"Mismatch: {len(chunks)} chunks but {len(embeddings)} embeddings")
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    try:
-        # Prepare data for batch insert
-        values = []
-        for chunk, embedding in zip(chunks, embeddings):
-            # Convert embedding to PostgreSQL vector format
-            embedding_str = '[' + ','.join(map(str, embedding)) + ']'
-            
-            # Remove null bytes from text (PostgreSQL doesn't allow them)
-            chunk_text = chunk['text'].replace('\x00', '').strip()
-            
-            # Skip empty chunks
-            if not chunk_text:
-                continue
-            
-            metadata_json = json.dumps(chunk.get('metadata', {}))
-            
-            values.append((
-                chunk_text,
-                embedding_str,
-                chunk['source_file'],
-                chunk.get('folder_path'),
-                chunk.get('page_number'),
-                chunk.get('chunk_index'),
-                metadata_json
-            ))
-        
-        # Batch insert
-        insert_query = """
-            INSERT INTO document_chunks 
-            (chunk_text, embedding, source_file, folder_path, page_number, chunk_index, metadata)
-            VALUES %s
-        """
-        
-        execute_values(cursor, insert_query, values)
-        conn.commit()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
         
-        logger.info(f"Stored {len(chunks)} chunks in database")
+        try:
+            # Build a binary COPY stream; embeddings go over the wire as raw floats
+            buffer = io.BytesIO()
+            buffer.write(_PGCOPY_HEADER)
+            rows = 0
+            for chunk, embedding in zip(chunks, embeddings):
+                # Remove null bytes from text (PostgreSQL doesn't allow them)
+                chunk_text = _clean_chunk_text(chunk['text'])
+                
+                # Skip empty chunks
+                if not chunk_text:
+                    continue
+                
+                metadata_json = json.dumps(chunk.get('metadata', {}))
+                
+                buffer.write(struct.pack('!h', 8))
+                buffer.write(_copy_text(chunk_text))
+                buffer.write(_copy_field(_encode_vector(embedding)))
+                buffer.write(_copy_text(chunk['source_file']))
+                buffer.write(_copy_text(chunk.get('folder_path')))
+                buffer.write(_copy_int(chunk.get('page_number')))
+                buffer.write(_copy_int(chunk.get('chunk_index')))
+                buffer.write(_copy_field(_JSONB_VERSION + metadata_json.encode('utf-8')))
+                buffer.write(_copy_field(chunk_content_hash(chunk)))
+                rows += 1
+            buffer.write(_PGCOPY_TRAILER)
+            buffer.seek(0)
+            
+            # COPY has no ON CONFLICT, so load into a staging table and insert from there
+            cursor.execute(f"""
+                CREATE TEMP TABLE document_chunks_staging (
+                    chunk_text TEXT,
+                    embedding {EMBEDDING_PRECISION}({EMBEDDING_DIM}),
+                    source_file TEXT,
+                    folder_path TEXT,
+                    page_number INTEGER,
+                    chunk_index INTEGER,
+                    metadata JSONB,
+                    content_hash BYTEA
+                ) ON COMMIT DROP;
+            """)
+            
+            copy_query = """
+                COPY document_chunks_staging
+                (chunk_text, embedding, source_file, folder_path, page_number, chunk_index, metadata, content_hash)
+                FROM STDIN WITH (FORMAT BINARY)
+            """
+            
+            cursor.copy_expert(copy_query, buffer)
+            cursor.execute("""
+                INSERT INTO document_chunks
+                (chunk_text, embedding, source_file, folder_path, page_number, chunk_index, metadata, content_hash)
+                SELECT chunk_text, embedding, source_file, folder_path, page_number, chunk_index, metadata, content_hash
+                FROM document_chunks_staging
+                ON CONFLICT (content_hash) DO NOTHING;
+            """)
+            inserted = cursor.rowcount
+            conn.commit()
+            
+            logger.info(f"Stored {inserted} chunks in database ({rows - inserted} already present)")
+            return inserted
+            
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Error storing embeddings: {e}")
+            raise
+        finally:
+            cursor.close()
+
+
+def get_ef_search(top_k: int, recall_preset: str = 'balanced') -> int:
+    """Map a recall preset to an hnsw.ef_search value (never below top_k, which would truncate results)."""
+    ef_search = int(get_hnsw_ef_search() * RECALL_PRESETS[recall_preset])
+    return min(HNSW_MAX_EF_SEARCH, max(top_k, ef_search))
+
+
+def _row_to_chunk(row: tuple, similarity: float) -> Dict[str, Any]:
+    """Convert a (chunk_text, source_file, folder_path, page_number, chunk_index, metadata) row to a chunk dict."""
+    # PostgreSQL JSONB returns as dict, not string
+    metadata = row[5] if row[5] else {}
+    if isinstance(metadata, str):
+        metadata = json.loads(metadata)
+    
+    return {
+        'text': row[0],
+        'source_file': row[1],
+        'folder_path': row[2],
+        'page_number': row[3],
+        'chunk_index': row[4],
+        'metadata': metadata,
+        'similarity': similarity
+    }
+
+
+def _search_similar_chunks_faiss(
+    query_embedding: List[float],
+    top_k: int,
+    threshold: float,
+    recall_preset: str
+) -> List[Dict[str, Any]]:
+    """Rank with the in-process FAISS index, then fetch the winning rows' metadata by id."""
+    hits = [
+        (chunk_id, similarity)
+        for chunk_id, similarity in search_faiss_index(query_embedding, top_k, get_ef_search(top_k, recall_preset))
+        if similarity >= threshold
+    ]
+    if not hits:
+        logger.info("Found 0 similar chunks")
+        return []
+    
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
         
-    except Exception as e:
-        conn.rollback()
-        logger.error(f"Error storing embeddings: {e}")
-        raise
-    finally:
-        cursor.close()
-        conn.close()
+        try:
+            cursor.execute("""
+                SELECT id, chunk_text, source_file, folder_path, page_number, chunk_index, metadata
+                FROM document_chunks
+                WHERE id = ANY(%s)
+            """, ([chunk_id for chunk_id, _ in hits],))
+            rows = {row[0]: row[1:] for row in cursor.fetchall()}
+        except Exception as e:
+            logger.error(f"Error fetching similar chunks: {e}")
+            raise
+        finally:
+            cursor.close()
+    
+    # Keep FAISS ranking; skip ids deleted since the index was built
+    chunks = [_row_to_chunk(rows[chunk_id], similarity) for chunk_id, similarity in hits if chunk_id in rows]
+    logger.info(f"Found {len(chunks)} similar chunks")
+    return chunks
 
 
 def search_similar_chunks(
     query_embedding: List[float],
     top_k: int = 5,
-    threshold: float = 0.0
+    threshold: float = 0.0,
+    recall_preset: str = 'balanced'
 ) -> List[Dict[str, Any]]:
     """
     Search for similar chunks using cosine similarity.
@@ -82,59 +363,211 @@ def search_similar_chunks(
         query_embedding: Query embedding vector
         top_k: Number of results to return
         threshold: Minimum similarity threshold (0-1)
+        recall_preset: 'fast', 'balanced' or 'high' (see RECALL_PRESETS)
     
     Returns:
         List of similar chunks with metadata and similarity scores
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    # Until the in-process index is built (or when it isn't configured), search in Postgres
+    if faiss_index_ready():
+        return _search_similar_chunks_faiss(query_embedding, top_k, threshold, recall_preset)
     
-    try:
-        # Convert embedding to PostgreSQL vector format
-        embedding_str = '[' + ','.join(map(str, query_embedding)) + ']'
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
         
-        # Use cosine similarity (1 - cosine_distance)
-        query = """
-            SELECT 
-                chunk_text,
-                source_file,
-                folder_path,
-                page_number,
-                chunk_index,
-                metadata,
-                1 - (embedding <=> %s::vector) as similarity
-            FROM document_chunks
-            WHERE 1 - (embedding <=> %s::vector) >= %s
-            ORDER BY embedding <=> %s::vector
-            LIMIT %s
-        """
+        try:
+            # Convert embedding to PostgreSQL vector format
+            embedding_str = _to_vector_literal(query_embedding)
+            
+            # Applies to this transaction only
+            cursor.execute("SET LOCAL hnsw.ef_search = %s", (get_ef_search(top_k, recall_preset),))
+            
+            # Use cosine similarity (1 - cosine_distance)
+            # The CTE takes the top_k nearest via the index (ORDER BY must stay on the raw
+            # distance expression for that) and computes the distance once per candidate;
+            # the threshold is then applied to those candidates only.
+            query = f"""
+                WITH scored AS (
+                    SELECT 
+                        chunk_text,
+                        source_file,
+                        folder_path,
+                        page_number,
+                        chunk_index,
+                        metadata,
+                        embedding <=> %(embedding)s::{EMBEDDING_PRECISION} as distance
+                    FROM document_chunks
+                    ORDER BY embedding <=> %(embedding)s::{EMBEDDING_PRECISION}
+                    LIMIT %(top_k)s
+                )
+                SELECT 
+                    chunk_text,
+                    source_file,
+                    folder_path,
+                    page_number,
+                    chunk_index,
+                    metadata,
+                    1 - distance as similarity
+                FROM scored
+                WHERE 1 - distance >= %(threshold)s
+                ORDER BY distance
+            """
+            
+            cursor.execute(query, {'embedding': embedding_str, 'top_k': top_k, 'threshold': threshold})
+            results = cursor.fetchall()
+            
+            chunks = [_row_to_chunk(row[:6], float(row[6])) for row in results]
+            
+            logger.info(f"Found {len(chunks)} similar chunks")
+            return chunks
+            
+        except Exception as e:
+            logger.error(f"Error searching similar chunks: {e}")
+            raise
+        finally:
+            cursor.close()
+
+
+def clear_all_chunks():
+    """Delete all document chunks and drop cached embeddings/answers that were built on them."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
         
-        cursor.execute(query, (embedding_str, embedding_str, threshold, embedding_str, top_k))
-        results = cursor.fetchall()
+        try:
+            cursor.execute("DELETE FROM document_chunks;")
+            cursor.execute("DELETE FROM cached_queries;")
+            conn.commit()
+            clear_cache()
+            reset_faiss_index()
+            logger.info("Cleared all document chunks")
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Error clearing document chunks: {e}")
+            raise
+        finally:
+            cursor.close()
+
+
+def search_cached_answer(
+    query_embedding: List[float],
+    top_k: int,
+    recall_preset: str
+) -> Optional[Dict[str, Any]]:
+    """
+    Look up the answer to a previous query that is near-identical to this one.
+    
+    Only answers built with the same retrieval settings are reused, since those decide
+    which chunks (and sources) the answer was generated from.
+    
+    Args:
+        query_embedding: Query embedding vector
+        top_k: Number of chunks the answer must have been built from
+        recall_preset: Search recall preset the answer must have been built with
+    
+    Returns:
+        Dictionary with answer and sources, or None on a miss
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
         
-        chunks = []
-        for row in results:
-            # PostgreSQL JSONB returns as dict, not string
-            metadata = row[5] if row[5] else {}
-            if isinstance(metadata, str):
-                metadata = json.loads(metadata)
-            
-            chunks.append({
-                'text': row[0],
-                'source_file': row[1],
-                'folder_path': row[2],
-                'page_number': row[3],
-                'chunk_index': row[4],
-                'metadata': metadata,
-                'similarity': float(row[6])
+        try:
+            query = f"""
+                SELECT id, answer, sources
+                FROM cached_queries
+                WHERE top_k = %(top_k)s
+                  AND recall_preset = %(recall_preset)s
+                  AND 1 - (embedding <=> %(embedding)s::{EMBEDDING_PRECISION}) > %(threshold)s
+                ORDER BY embedding <=> %(embedding)s::{EMBEDDING_PRECISION}
+                LIMIT 1
+            """
+            cursor.execute(query, {
+                'embedding': _to_vector_literal(query_embedding),
+                'threshold': SEMANTIC_CACHE_THRESHOLD,
+                'top_k': top_k,
+                'recall_preset': recall_preset
             })
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            
+            cursor.execute("""
+                UPDATE cached_queries
+                SET hit_count = hit_count + 1, last_hit_at = CURRENT_TIMESTAMP
+                WHERE id = %s;
+            """, (row[0],))
+            conn.commit()
+            
+            sources = row[2] if row[2] else []
+            if isinstance(sources, str):
+                sources = json.loads(sources)
+            return {
+                'answer': row[1],
+                'sources': sources
+            }
+            
+        except Exception as e:
+            conn.rollback()
+            # The cache is an optimization; a failure here should not fail the query
+            logger.warning(f"Error searching cached answers: {e}")
+            return None
+        finally:
+            cursor.close()
+
+
+def store_cached_answer(
+    query_text: str,
+    query_embedding: List[float],
+    answer: str,
+    sources: List[str],
+    top_k: int,
+    recall_preset: str
+):
+    """
+    Add a generated answer to the semantic cache, evicting the least recently used entries beyond the size cap.
+    
+    Args:
+        query_text: Original query
+        query_embedding: Query embedding vector
+        answer: Generated answer
+        sources: Source citations for the answer
+        top_k: Number of chunks the answer was built from
+        recall_preset: Search recall preset the answer was built with
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
         
-        logger.info(f"Found {len(chunks)} similar chunks")
-        return chunks
+        try:
+            cursor.execute(f"""
+                INSERT INTO cached_queries (query_text, embedding, answer, sources, top_k, recall_preset)
+                VALUES (%s, %s::{EMBEDDING_PRECISION}, %s, %s, %s, %s)
+            """, (query_text, _to_vector_literal(query_embedding), answer, json.dumps(sources), top_k, recall_preset))
+            cursor.execute("""
+                DELETE FROM cached_queries
+                WHERE id IN (
+                    SELECT id FROM cached_queries
+                    ORDER BY last_hit_at DESC, hit_count DESC
+                    OFFSET %s
+                )
+            """, (SEMANTIC_CACHE_MAX_ROWS,))
+            conn.commit()
+            
+        except Exception as e:
+            conn.rollback()
+            logger.warning(f"Error storing cached answer: {e}")
+        finally:
+            cursor.close()
+
+
+def clear_cached_answers():
+    """Delete all semantic cache entries (e.g. after the document corpus changed)."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
         
-    except Exception as e:
-        logger.error(f"Error searching similar chunks: {e}")
-        raise
-    finally:
-        cursor.close()
-        conn.close()
+        try:
+            cursor.execute("DELETE FROM cached_queries;")
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            logger.warning(f"Error clearing cached answers: {e}")
+        finally:
+            cursor.close()